@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""In-memory cache of PIC-SURE metadata responses"""
+import threading
+import time
+from concurrent.futures import Future
+
+
+def isCacheable(content):
+    """ Only successful responses are kept, failed requests come back as a dict or an "ERROR:" listing """
+    return isinstance(content, str) and not content.startswith('["ERROR:')
+
+
+class MetadataCache:
+    """ Thread safe cache of metadata responses keyed by a tuple such as ("info", resource_uuid).
+
+        Values can be loaded in the background with prefetch(); get() waits for a load that is
+        already in flight instead of sending a second request.  Entries older than max_age seconds
+        are reloaded on their next use.
+    """
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._entries = {}
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def prefetch(self, key, loader, executor, valid=isCacheable):
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+            future = executor.submit(loader)
+            self._entries[key] = future
+            self._loaded[key] = time.time()
+        future.add_done_callback(lambda done: self._discardFailed(key, done, valid))
+        return future
+
+    def get(self, key, loader, valid=isCacheable):
+        with self._lock:
+            future = self._entries.get(key)
+            loaded = self._loaded.get(key)
+        if future is not None and self.max_age is not None and time.time() - loaded > self.max_age:
+            self._discard(key, future)
+            future = None
+        if future is not None:
+            try:
+                content = future.result()
+                if valid(content):
+                    return content
+            except Exception:
+                pass
+            self._discard(key, future)
+
+        content = loader()
+        if valid(content):
+            self.put(key, content)
+        return content
+
+    def put(self, key, content, loaded=None):
+        future = Future()
+        future.set_result(content)
+        with self._lock:
+            self._entries[key] = future
+            self._loaded[key] = time.time() if loaded is None else loaded
+
+    def snapshot(self):
+        """ Returns (key, content, load time) for every entry that has finished loading successfully """
+        with self._lock:
+            entries = [(key, future, self._loaded[key]) for key, future in self._entries.items()]
+        return [(key, future.result(), loaded) for key, future, loaded in entries
+                if future.done() and not future.cancelled() and future.exception() is None]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._loaded.clear()
+
+    def _discard(self, key, future):
+        with self._lock:
+            if self._entries.get(key) is future:
+                del self._entries[key]
+                del self._loaded[key]
+
+    def _discardFailed(self, key, future, valid):
+        if future.exception() is not None or not valid(future.result()):
+            self._discard(key, future)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""Adaptive limit on the number of requests in flight"""
+import threading
+import time
+
+
+class ConcurrencyLimiter:
+    """ Additive-increase/multiplicative-decrease limit on in-flight requests, driven by errors and latency """
+    def __init__(self, initial=4, minimum=1, maximum=64, backoff=0.5, tolerance=2.0, alpha=0.2, window=60.0):
+        self._limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.alpha = alpha
+        # the baseline is the lowest moving average latency seen over the last one to two windows of seconds
+        self.window = window
+        self.inflight = 0
+        self.latency = None
+        self.baseline = None
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._window_start = None
+        self._window_low = None
+        self._previous_low = None
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        """ The current number of requests allowed in flight """
+        return max(self.minimum, int(self._limit))
+
+    def acquire(self, timeout=None):
+        """ Waits for a free slot, returns False if none became free within timeout seconds """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.inflight < self.limit, timeout):
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self, latency, status=None):
+        """ Frees a slot and adjusts the limit, status is None when no response was received """
+        with self._condition:
+            self.inflight -= 1
+            now = time.monotonic()
+            if status is not None and status < 500 and status != 429:
+                self.latency = latency if self.latency is None else \
+                    self.alpha * latency + (1 - self.alpha) * self.latency
+                overloaded = self._updateBaseline(now)
+            else:
+                overloaded = True
+
+            if overloaded:
+                if now - self._last_decrease >= (self.latency or 0.0):
+                    self._limit = max(float(self.minimum), self._limit * self.backoff)
+                    self._last_decrease = now
+                    self.decreases += 1
+            else:
+                self._limit = min(float(self.maximum), self._limit + 1.0 / self._limit)
+            self._condition.notify_all()
+
+    def _updateBaseline(self, now):
+        """ Moves the baseline to the windowed minimum latency, returns True if the server looks overloaded """
+        if self._window_start is None or now - self._window_start >= self.window:
+            self._previous_low, self._window_low, self._window_start = self._window_low, self.latency, now
+        else:
+            self._window_low = min(self._window_low, self.latency)
+        low = self._window_low if self._previous_low is None else min(self._window_low, self._previous_low)
+
+        # old lows expire with their window, but the baseline only rises while latency is within tolerance
+        # (or once backing off cannot lower it any more), so a slow build-up under load is still seen
+        overloaded = self.baseline is not None and self.latency > self.baseline * self.tolerance
+        if self.baseline is None or low < self.baseline or not overloaded or self._limit <= self.minimum:
+            self.baseline = low
+        return self.latency > self.baseline * self.tolerance
+
+    def metrics(self):
+        with self._condition:
+            return {"limit": self.limit, "inflight": self.inflight, "latency": self.latency,
+                    "baseline": self.baseline, "decreases": self.decreases}
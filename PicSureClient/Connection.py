@@ -1,12 +1,44 @@
 # -*- coding: utf-8 -*-
 
 """PIC-SURE Connection and Authorization Library"""
+import logging
+import os
+import time
+import weakref
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
 import urllib3
 
 import PicSureClient
 import json
 from urllib.parse import urlparse
 
+from .Cache import MetadataCache
+from .Concurrency import ConcurrencyLimiter
+from .Endpoints import EndpointPool
+from .Parsing import parseCsv
+from .Profiling import RequestProfiler
+
+PROFILE_ERROR = '{"results":{}, "error":"true"}'
+
+# bytes read at a time when a result is streamed to a file
+STREAM_CHUNK_SIZE = 1 << 16
+
+logger = logging.getLogger(__name__)
+
+try:
+    from contextlib import nullcontext
+except ImportError:
+    # Python 3.6
+    @contextmanager
+    def nullcontext():
+        yield
+
+# one resource's answer to a federated query, error holds the exception raised for that resource or None
+FederatedResult = namedtuple("FederatedResult", ["resource_uuid", "result", "error"])
+
 
 class Client:
     @classmethod
@@ -19,13 +51,24 @@ class Client:
         [HELP] PicSureClient.Client()
             .version()                                                 gives version information for library
             .connect(<url>, <token> [, allowSelfSignedSSL = True])     returns a connection object
+            .connect([<url>, <url>, ...], <token>)                     returns a connection object which fails over
+                                                                       between equivalent endpoints
             .connect_local(<token>)                                   return a connection object from all-in-one stack
+            .restore(<path> [, token = <token>])                       return a connection object from a saved session
+
+            Call .close() on a connection when done with it, or use it in a with block, to stop its
+            background endpoint health checks.
+
+            connect options: structured=True raises PicSureHttpError instead of printing errors,
+                             prefetch=True loads resource details in the background,
+                             connect_timeout/read_timeout set request timeouts in seconds
+                             concurrency=True adapts the number of requests in flight to server latency
         """)
 
     @classmethod
-    def connect(self, url, token, allowSelfSignedSSL=False):
+    def connect(self, url, token, allowSelfSignedSSL=False, **kwargs):
         """ PicSure.connect returns a configured instance of a PicSureClient.Connection class """
-        return PicSureClient.Connection(url, token, allowSelfSignedSSL)
+        return PicSureClient.Connection(url, token, allowSelfSignedSSL, **kwargs)
 
     ####
     ## Use kwargs to override some initializations in Connection class
@@ -40,12 +83,34 @@ class Client:
         return PicSureClient.Connection('http://wildfly:8080/pic-sure-api-2/PICSURE/', token, allowSelfSignedSSL,
                                         **kwargs)
 
+    @classmethod
+    def restore(self, path, token=None, max_age=None, **kwargs):
+        """ PicSure.restore returns a Connection rebuilt from a file written by Connection.saveSession """
+        with open(path, 'r') as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        token = token if token is not None else snapshot.get("token")
+        if token is None:
+            raise PicSureClientException("the session snapshot does not hold a token, pass token= to restore it")
+        if len(snapshot["urls"]) == 1 or snapshot.get("psama_override") is not None:
+            kwargs.setdefault("psama_override", snapshot["psama_url"])
+        return PicSureClient.Connection(snapshot["urls"], token, snapshot["allowSelfSignedSSL"],
+                                        snapshot=snapshot, max_age=max_age, **kwargs)
+
 
 class Connection:
     def __init__(self, url, token, allowSelfSignedSSL=False, **kwargs):
-        url_ret = urlparse(url)
-        self.psama_url = url_ret.scheme + "://" + url_ret.netloc + "/psama/"
-        self.url = url_ret.scheme + "://" + url_ret.netloc + url_ret.path
+        # a list of equivalent endpoints may be given, the first one is used until latencies are known
+        urls = [url] if isinstance(url, str) else list(url)
+        picsure_urls = []
+        psama_urls = []
+        for endpoint_url in urls:
+            url_ret = urlparse(endpoint_url)
+            psama_urls.append(url_ret.scheme + "://" + url_ret.netloc + "/psama/")
+            picsure_url = url_ret.scheme + "://" + url_ret.netloc + url_ret.path
+            picsure_urls.append(picsure_url if picsure_url.endswith("/") else picsure_url + "/")
+
+        self.psama_url = psama_urls[0]
+        self.url = picsure_urls[0]
 
         if 'psama_override' in kwargs:
             self.psama_url = kwargs.get('psama_override')
@@ -62,9 +127,43 @@ class Connection:
 
         self.AllowSelfSigned = allowSelfSignedSSL
 
-        self.httpConn = PicSureHttpClient(url=self.url, token=self._token, allowSelfSigned=self.AllowSelfSigned)
-
-        if allowSelfSignedSSL is True:
+        self.endpoints = None
+        self.psama_endpoints = None
+        self.psama_override = kwargs.get('psama_override')
+        if len(urls) > 1:
+            # health checks start with the first routed request, so a restored session makes no requests
+            interval = kwargs.get('health_check_interval', 30.0)
+            self.endpoints = EndpointPool(picsure_urls, self._token, self.AllowSelfSigned, interval=interval,
+                                          autostart=True)
+            if 'psama_override' not in kwargs:
+                self.psama_endpoints = EndpointPool(psama_urls, self._token, self.AllowSelfSigned,
+                                                    probePath="user/me", interval=interval, autostart=True)
+        # stop the health checks when the connection is garbage collected, e.g. when a notebook cell is rerun
+        self._finalizer = weakref.finalize(self, _stopPools, [self.endpoints, self.psama_endpoints])
+
+        self.connect_timeout = kwargs.get('connect_timeout')
+        self.read_timeout = kwargs.get('read_timeout')
+
+        # structured mode raises PicSureHttpError and logs instead of printing to stdout
+        self.structured = bool(kwargs.get('structured', False))
+        self.profiler = kwargs.get('profiler')
+        # ConcurrencyLimiter shared by every request of this connection, True creates one with default settings
+        self.concurrency = kwargs.get('concurrency')
+        if self.concurrency is True:
+            self.concurrency = ConcurrencyLimiter()
+        # connections kept open per host, set it to the number of threads sending requests at once
+        self.pool_size = kwargs.get('pool_size')
+
+        self.httpConn = PicSureHttpClient(url=self.url, token=self._token, allowSelfSigned=self.AllowSelfSigned,
+                                          endpoints=self.endpoints, connect_timeout=self.connect_timeout,
+                                          read_timeout=self.read_timeout, structured=self.structured,
+                                          profiler=self.profiler, concurrency=self.concurrency,
+                                          pool_size=self.pool_size)
+
+        if allowSelfSignedSSL is True and self.structured:
+            logger.warning("Self-signed SSL certificates are accepted for %s, this should never be done "
+                           "for systems hosting sensitive data", self.url)
+        elif allowSelfSignedSSL is True:
             # user is allowing self-signed SSL certs, serve them a black box warning
             print("""\033[38;5;91;40m\n
 +=========================================================================================+
@@ -76,14 +175,45 @@ class Connection:
 +=========================================================================================+
 \033[39;49m""")
 
-        # test server connection and automatically list all the Resource UUIDs
-        self.list()
+        # opt-in cache of info/{uuid} and PSAMA profile responses, loaded in the background after connecting
+        snapshot = kwargs.get('snapshot')
+        self.max_age = kwargs.get('max_age')
+        self.cache = None
+        if kwargs.get('prefetch') or kwargs.get('prefetch_profile') or snapshot is not None:
+            self.cache = MetadataCache(max_age=self.max_age)
+
+        self._listing = None
+        self._listing_time = None
+        if snapshot is not None:
+            for key, content, loaded in snapshot["cache"]:
+                self.cache.put(tuple(key), content, loaded)
+            self._setListing(snapshot["listing"], snapshot["listing_time"])
+            if self.endpoints is not None and snapshot.get("endpoints"):
+                self.endpoints.restoreState(snapshot["endpoints"])
+            if self.psama_endpoints is not None and snapshot.get("psama_endpoints"):
+                self.psama_endpoints.restoreState(snapshot["psama_endpoints"])
+            logger.debug("Restored session for %s saved at %s", self.url, snapshot["saved_at"])
+
+        # test server connection and automatically list all the Resource UUIDs, unless a fresh listing was restored
+        if self._listing is None or self._listingIsStale():
+            if self.structured:
+                self.getResources()
+                logger.debug("Connected to %s, %d resources available", self.url, len(self.resource_uuids))
+            else:
+                self.list()
+
+        if kwargs.get('prefetch') or kwargs.get('prefetch_profile'):
+            self.prefetch(info=bool(kwargs.get('prefetch')), profile=bool(kwargs.get('prefetch_profile')),
+                          workers=kwargs.get('prefetch_workers', 8))
 
     def help(self):
         print("""
         [HELP] PicSureClient.Client.connect(url, token [, allowSelfSignedSSL = True])
             .list()                         Prints a list of available resources
             .about(resource_uuid)           Prints details about a specific resource
+            .prefetch()                     Loads details about every resource in the background
+            .close()                        Stops endpoint health checks and closes connections
+            .saveSession(path)              Saves resources, profile and cached details for Client.restore()
 
         [Connect to Resource]
             To connect to a resource load its associated resource code library
@@ -133,8 +263,26 @@ class Connection:
             print("!!!! ERROR !!!!")
             print(json.dumps(listing, indent=2))
 
+    def prefetch(self, info=True, profile=False, workers=8):
+        """ Loads info for every listed resource, and optionally the PSAMA profile, concurrently in the background """
+        if self.cache is None:
+            self.cache = MetadataCache(max_age=self.max_age)
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="PicSurePrefetch")
+        if info:
+            for uuid in self.resource_uuids:
+                self.cache.prefetch(("info", uuid), lambda uuid=uuid: self.httpConn.post("info/" + uuid, data='{}'),
+                                    executor)
+        if profile:
+            self.cache.prefetch(("profile",), self._api_obj()._loadProfile, executor,
+                                valid=lambda content: content != PROFILE_ERROR)
+        # queued loads still run, the worker threads exit once they are done
+        executor.shutdown(wait=False)
+
     def getInfo(self, uuid):
-        content = self.httpConn.post("info/" + str(uuid))
+        if self.cache is not None:
+            content = self.cache.get(("info", str(uuid)), lambda: self.httpConn.post("info/" + str(uuid)))
+        else:
+            content = self.httpConn.post("info/" + str(uuid))
         if hasattr(content, 'error') and content.error is True:
             return {"error": True, "headers": content.headers, "content": json.loads(content)}
         return content
@@ -155,9 +303,8 @@ class Connection:
                 else:
                     return '["ERROR:", "    See message above."]'.encode()
         else:
-            self.resource_uuids = json.dumps(content)
-            if type(self.resource_uuids) == dict:
-                self.resource_uuids = list(self.resource_uuids.keys())
+            if isinstance(content, str) and not content.startswith('["ERROR:'):
+                self._setListing(content, time.time())
 
             # We need to return a string, not a dict
             if type(content) == dict:
@@ -165,9 +312,81 @@ class Connection:
 
             return content
 
+    def close(self):
+        """ Stops the endpoint health checks and closes pooled connections """
+        self._finalizer()
+        self.httpConn.http.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _setListing(self, content, listed_at):
+        listing = json.loads(content)
+        if type(listing) == dict:
+            self.resource_uuids = list(listing.keys())
+        else:
+            self.resource_uuids = list(listing)
+        self._listing = content
+        self._listing_time = listed_at
+
+    def _listingIsStale(self):
+        return self.max_age is not None and time.time() - self._listing_time > self.max_age
+
+    def saveSession(self, path, include_token=False):
+        """ Writes the resource listing, PSAMA profile and cached metadata to path so Client.restore can rebuild
+            this connection without any requests.  The token is only saved when include_token is True. """
+        if self.cache is None:
+            self.cache = MetadataCache(max_age=self.max_age)
+        if self._listing is None:
+            self.getResources()
+        if self._listing is None:
+            raise PicSureClientException("the resource listing could not be loaded, the session was not saved")
+        # the profile holds the query template adapters need, load it now so restoring needs no request
+        self._api_obj().profile()
+
+        snapshot = {
+            "urls": self.endpoints.urls if self.endpoints is not None else [self.url],
+            "psama_url": self.psama_url,
+            "psama_override": self.psama_override,
+            "endpoints": self.endpoints.state() if self.endpoints is not None else None,
+            "psama_endpoints": self.psama_endpoints.state() if self.psama_endpoints is not None else None,
+            "allowSelfSignedSSL": self.AllowSelfSigned,
+            "saved_at": time.time(),
+            "listing": self._listing,
+            "listing_time": self._listing_time,
+            "cache": [[list(key), content, loaded] for key, content, loaded in self.cache.snapshot()],
+        }
+        if include_token:
+            snapshot["token"] = self._token
+        # the file may hold a token, keep it readable by the owner only
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        if hasattr(os, 'fchmod'):
+            # the mode given to os.open only applies when it creates the file
+            os.fchmod(descriptor, 0o600)
+        with os.fdopen(descriptor, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+
     def _api_obj(self):
         """PicSureClient._api_obj() function returns a new, preconfigured PicSureConnectionAPI class instance """
-        return PicSureConnectionAPI(self.url, self.psama_url, self._token, allowSelfSignedSSL=self.AllowSelfSigned)
+        return PicSureConnectionAPI(self.url, self.psama_url, self._token, allowSelfSignedSSL=self.AllowSelfSigned,
+                                    endpoints=self.endpoints, psama_endpoints=self.psama_endpoints,
+                                    connect_timeout=self.connect_timeout, read_timeout=self.read_timeout,
+                                    cache=self.cache, structured=self.structured, profiler=self.profiler,
+                                    concurrency=self.concurrency, pool_size=self.pool_size)
+
+
+def _errorMessage(content):
+    """ Returns the message of an '["ERROR:", "   message"]' listing returned for a failed request """
+    return json.loads(content)[-1].strip()
+
+
+def _stopPools(pools):
+    for pool in pools:
+        if pool is not None:
+            pool.stop()
 
 
 class PicSureClientException(Exception):
@@ -178,23 +397,77 @@ class PicSureClientException(Exception):
         return "Error: %s" % self.value
 
 
+class PicSureHttpError(PicSureClientException):
+    """ Raised by structured clients for non-200 responses, status is None when the server could not be reached """
+    def __init__(self, status, message, url):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.url = url
+
+    def __str__(self):
+        if self.status is None:
+            return "Error: %s (%s)" % (self.message, self.url)
+        return "Error: HTTP %s %s (%s)" % (self.status, self.message, self.url)
+
+
+class DeadlineExceeded(PicSureClientException):
+    pass
+
+
+class Deadline:
+    """ A point in time shared by every request of one operation, each request gets only the time remaining """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded("deadline of %ss has expired" % self.seconds)
+
+    def timeout(self, connect=None, read=None):
+        """ Returns a urllib3.Timeout capped to the remaining budget """
+        remaining = self.remaining()
+        return urllib3.Timeout(total=remaining,
+                               connect=remaining if connect is None else min(connect, remaining),
+                               read=remaining if read is None else min(read, remaining))
+
+
 class PicSureConnectionAPI:
-    def __init__(self, url_picsure, url_psama, token, allowSelfSignedSSL=False):
+    def __init__(self, url_picsure, url_psama, token, allowSelfSignedSSL=False, **kwargs):
 
         # save values
         self.url_picsure = url_picsure
         self.url_psama = url_psama
         self._token = token
         self.AllowSelfSigned = allowSelfSignedSSL
-        self.psamaHttpConnect = PicSureHttpClient(self.url_psama, self._token, self.AllowSelfSigned)
-        self.picsureHttpConnect = PicSureHttpClient(self.url_picsure, self._token, self.AllowSelfSigned)
+        options = {'connect_timeout': kwargs.get('connect_timeout'), 'read_timeout': kwargs.get('read_timeout'),
+                   'structured': kwargs.get('structured', False), 'profiler': kwargs.get('profiler'),
+                   'concurrency': kwargs.get('concurrency'), 'pool_size': kwargs.get('pool_size')}
+        self.psamaHttpConnect = PicSureHttpClient(self.url_psama, self._token, self.AllowSelfSigned,
+                                                  endpoints=kwargs.get('psama_endpoints'), **options)
+        self.picsureHttpConnect = PicSureHttpClient(self.url_picsure, self._token, self.AllowSelfSigned,
+                                                    endpoints=kwargs.get('endpoints'), **options)
+        # MetadataCache shared with the Connection which created this object, None disables caching
+        self.cache = kwargs.get('cache')
 
     def profile(self):
+        if self.cache is not None:
+            return self.cache.get(("profile",), self._loadProfile, valid=lambda content: content != PROFILE_ERROR)
+        return self._loadProfile()
+
+    def _loadProfile(self):
         response_str = self.psamaHttpConnect.get("user/me")
 
         if hasattr(response_str, 'error') and response_str.error:
             print("ERROR: HTTP response was bad requesting PSAMA profile")
-            return '{"results":{}, "error":"true"}'
+            return PROFILE_ERROR
 
         # Make sure we have a "queryTemplate"
         response_objs = json.loads(response_str)
@@ -203,14 +476,18 @@ class PicSureConnectionAPI:
             content = self.psamaHttpConnect.get("user/me/queryTemplate/")
             if hasattr(content, 'error') and content.error:
                 print("ERROR: HTTP response was bad requesting application queryTemplate")
-                return '{"results":{}, "error":"true"}'
+                return PROFILE_ERROR
             else:
                 response_objs["queryTemplate"] = json.loads(content)["queryTemplate"]
         return json.dumps(response_objs)
 
     def info(self, resource_uuid):
         # https://github.com/hms-dbmi/pic-sure/blob/master/pic-sure-resources/pic-sure-resource-api/src/main/java/edu/harvard/dbmi/avillach/service/ResourceWebClient.java#L43
-        content = self.picsureHttpConnect.post("info/" + resource_uuid, data='{}')
+        if self.cache is not None:
+            content = self.cache.get(("info", resource_uuid),
+                                     lambda: self.picsureHttpConnect.post("info/" + resource_uuid, data='{}'))
+        else:
+            content = self.picsureHttpConnect.post("info/" + resource_uuid, data='{}')
         if hasattr(content, 'error') and content.error:
             return json.dumps(content)
         return content
@@ -224,33 +501,89 @@ class PicSureConnectionAPI:
             return json.dumps(content)
         return content
 
-    def asyncQuery(self, resource_uuid, query):
+    def asyncQuery(self, resource_uuid, query, deadline=None):
         # make sure a Resource UUID is passed via the body of these commands
         # https://github.com/hms-dbmi/pic-sure/blob/master/pic-sure-resources/pic-sure-resource-api/src/main/java/edu/harvard/dbmi/avillach/service/ResourceWebClient.java#L98
-        content = self.picsureHttpConnect.post("query", data=query)
+        content = self.picsureHttpConnect.post("query", data=query, deadline=deadline)
         if hasattr(content, 'error') and content.error:
             raise PicSureClientException('An error has occurred with the server')
         return content
 
-    def syncQuery(self, resource_uuid, query):
+    def syncQuery(self, resource_uuid, query, deadline=None, out=None):
         # make sure a Resource UUID is passed via the body of these commands
         # https://github.com/hms-dbmi/pic-sure/blob/master/pic-sure-resources/pic-sure-resource-api/src/main/java/edu/harvard/dbmi/avillach/service/ResourceWebClient.java#L186
-        content = self.picsureHttpConnect.post("query/sync", data=query)
+        # with out, the result is streamed into that binary file and the number of bytes written is returned
+        content = self.picsureHttpConnect.post("query/sync", data=query, deadline=deadline, out=out)
         if hasattr(content, 'error') and content.error:
             return json.dumps(content)
         return content
 
-    def queryStatus(self, resource_uuid, query_uuid, query_body="{}"):
+    def queryStatus(self, resource_uuid, query_uuid, query_body="{}", deadline=None):
         # https://github.com/hms-dbmi/pic-sure/blob/master/pic-sure-resources/pic-sure-resource-api/src/main/java/edu
         # /harvard/dbmi/avillach/service/ResourceWebClient.java#L124 We need to supply a fully formed query body so
         # PSAMA can parse it.  The adapter should pass in an appropriate template.
         query_obj = json.loads(query_body)
         query = {"resourceUUID": resource_uuid, "query": query_obj, "resourceCredentials": {}}
-        content = self.picsureHttpConnect.post("query/" + query_uuid + "/status", data=json.dumps(query))
+        content = self.picsureHttpConnect.post("query/" + query_uuid + "/status", data=json.dumps(query),
+                                               deadline=deadline)
         if hasattr(content, 'error') and content.error:
             return json.dumps(content)
         return content
 
+    def awaitQuery(self, resource_uuid, query_uuid, query_body="{}", deadline=None, interval=1.0):
+        """ Polls queryStatus until the query is no longer queued or running and returns the last status """
+        while True:
+            content = self.queryStatus(resource_uuid, query_uuid, query_body, deadline=deadline)
+            try:
+                status = json.loads(content).get("status")
+            except (ValueError, AttributeError):
+                return content
+            if status not in ("QUEUED", "PENDING", "RUNNING"):
+                return content
+            if deadline is not None:
+                deadline.check()
+                time.sleep(min(interval, deadline.remaining()))
+                deadline.check()
+            else:
+                time.sleep(interval)
+
+    def federatedQuery(self, resource_uuids, query, deadline=None, max_workers=None):
+        """ Sends the same query to every resource at once and returns an iterator of a FederatedResult per
+            resource in the order they complete, so the whole run takes as long as the slowest resource """
+        query_obj = json.loads(query) if isinstance(query, str) else query
+        url = self.url_picsure + "query/sync"
+
+        def run(resource_uuid):
+            body = dict(query_obj)
+            body["resourceUUID"] = resource_uuid
+            try:
+                content = self.syncQuery(resource_uuid, json.dumps(body), deadline)
+            except Exception as e:
+                return FederatedResult(resource_uuid, None, e)
+            # unstructured clients return failures instead of raising them
+            if isinstance(content, dict) and content.get("error"):
+                error = PicSureHttpError(content.get("status"), content.get("message", "HTTP error"), url)
+                return FederatedResult(resource_uuid, None, error)
+            if isinstance(content, str) and content.startswith('["ERROR:'):
+                return FederatedResult(resource_uuid, None, PicSureHttpError(None, _errorMessage(content), url))
+            return FederatedResult(resource_uuid, content, None)
+
+        executor = ThreadPoolExecutor(max_workers=max_workers or len(resource_uuids) or 1,
+                                      thread_name_prefix="PicSureFederated")
+        futures = [executor.submit(run, resource_uuid) for resource_uuid in resource_uuids]
+        # queued queries still run, the worker threads exit once they are done
+        executor.shutdown(wait=False)
+
+        def results():
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                # stop queued resources if the caller abandons the iterator early
+                for future in futures:
+                    future.cancel()
+        return results()
+
     # This operation is handled entirely in PIC-SURE, and does not need a resource connection
     def queryMetadata(self, query_uuid):
         content = self.picsureHttpConnect.get("query/" + query_uuid + "/metadata")
@@ -258,13 +591,24 @@ class PicSureConnectionAPI:
             return json.dumps(content)
         return content
 
-    def queryResult(self, resource_uuid, query_uuid):
+    def queryResult(self, resource_uuid, query_uuid, deadline=None):
         # https://github.com/hms-dbmi/pic-sure/blob/master/pic-sure-resources/pic-sure-resource-api/src/main/java/edu/harvard/dbmi/avillach/service/ResourceWebClient.java#L155
-        content = self.picsureHttpConnect.post("query/" + query_uuid + "/result", data='{}')
+        content = self.picsureHttpConnect.post("query/" + query_uuid + "/result", data='{}', deadline=deadline)
         if hasattr(content, 'error') and content.error:
             return json.dumps(content)
         return content
 
+    def queryResultColumns(self, resource_uuid, query_uuid, deadline=None, processes=None):
+        """ Downloads a CSV query result and parses it on all cores into a dict of column name -> ChunkedColumn """
+        content = self.queryResult(resource_uuid, query_uuid, deadline=deadline)
+        url = self.url_picsure + "query/" + query_uuid + "/result"
+        if isinstance(content, dict):
+            raise PicSureHttpError(content.get("status"), content.get("message", "HTTP error"), url)
+        if content.startswith('["ERROR:'):
+            raise PicSureHttpError(None, _errorMessage(content), url)
+        with self.picsureHttpConnect.phase("parse", "query/" + query_uuid + "/result"):
+            return parseCsv(content, processes=processes)
+
     def searchGenomicConceptValues(self, resource_uuid, genomicConceptPath, query):
         content = self.picsureHttpConnect.get("search/" + resource_uuid + "/values/", {'genomicConceptPath': genomicConceptPath, 'query': query, 'page': 1, 'size': 10000})
         return json.loads(content)['results']
@@ -275,40 +619,162 @@ class PicSureHttpClient:
         self.url = url
         self.token = token
         self.allowSelfSigned = allowSelfSigned
+        # optional EndpointPool of equivalent base URLs to route between, self.url is used when there is none
+        self.endpoints = kwargs.get('endpoints')
+        # per request timeouts in seconds, None waits forever
+        self.connect_timeout = kwargs.get('connect_timeout')
+        self.read_timeout = kwargs.get('read_timeout')
+        self.structured = bool(kwargs.get('structured', False))
+        # optional RequestProfiler recording time and memory for the receive and decode phase of each request
+        self.profiler = kwargs.get('profiler')
+        # optional ConcurrencyLimiter, requests wait for a slot and report their latency and status to it
+        self.concurrency = kwargs.get('concurrency')
+        pool_kwargs = {}
+        # connections kept open per host, raise it to the number of threads sharing this client
+        if kwargs.get('pool_size') is not None:
+            pool_kwargs['maxsize'] = kwargs.get('pool_size')
+        if self.connect_timeout is not None or self.read_timeout is not None:
+            pool_kwargs['timeout'] = urllib3.Timeout(connect=self.connect_timeout, read=self.read_timeout)
         if self.allowSelfSigned is True:
             urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-            self.http = urllib3.PoolManager(cert_reqs='CERT_NONE')
+            self.http = urllib3.PoolManager(cert_reqs='CERT_NONE', **pool_kwargs)
         else:
-            self.http = urllib3.PoolManager()
-
-    def get(self, path, params=None):
-        return self._request('GET', path, params)
-
-    def post(self, path, params=None, data=None):
-        return self._request('POST', path, params, data)
-
-    def put(self, path, params=None, data=None):
-        return self._request('PUT', path, params, data)
-
-    def delete(self, path, params=None):
-        return self._request('DELETE', path, params)
-
-    def _request(self, method, path, params=None, data=None):
+            self.http = urllib3.PoolManager(**pool_kwargs)
+
+    def get(self, path, params=None, deadline=None):
+        return self._request('GET', path, params, deadline=deadline)
+
+    def post(self, path, params=None, data=None, deadline=None, out=None):
+        return self._request('POST', path, params, data, deadline=deadline, out=out)
+
+    def put(self, path, params=None, data=None, deadline=None):
+        return self._request('PUT', path, params, data, deadline=deadline)
+
+    def delete(self, path, params=None, deadline=None):
+        return self._request('DELETE', path, params, deadline=deadline)
+
+    @contextmanager
+    def profiling(self):
+        """ Profiles every request made inside the with block and yields the RequestProfiler """
+        previous = self.profiler
+        with RequestProfiler() as profiler:
+            self.profiler = profiler
+            try:
+                yield profiler
+            finally:
+                self.profiler = previous
+
+    def phase(self, name, url=None):
+        """ Returns a context manager recording one phase of a request, it does nothing unless profiling """
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.phase(name, url)
+
+    def _send(self, method, url, params, data, headers, deadline=None, **kwargs):
+        # a deadline replaces the configured timeouts with the remaining budget and disables retries
+        if deadline is not None:
+            deadline.check()
+            kwargs['timeout'] = deadline.timeout(self.connect_timeout, self.read_timeout)
+            kwargs['retries'] = False
+        if self.concurrency is None:
+            with self.phase("receive", url):
+                return self.http.request(method, url, fields=params, body=data, headers=headers, **kwargs)
+
+        if not self.concurrency.acquire(None if deadline is None else deadline.remaining()):
+            raise DeadlineExceeded("deadline of %ss expired waiting for a request slot" % deadline.seconds)
+        if deadline is not None:
+            kwargs['timeout'] = deadline.timeout(self.connect_timeout, self.read_timeout)
+        status = None
+        start = time.perf_counter()
+        try:
+            with self.phase("receive", url):
+                response = self.http.request(method, url, fields=params, body=data, headers=headers, **kwargs)
+            status = response.status
+            return response
+        finally:
+            self.concurrency.release(time.perf_counter() - start, status)
+
+    def _request(self, method, path, params=None, data=None, deadline=None, out=None):
+        if self.endpoints is not None:
+            return self._routedRequest(method, path, params, data, deadline, out)
         url = self.url + path
         headers = self.setHeaders()
+        stream = {} if out is None else {'preload_content': False}
         try:
-            response = self.http.request(method, url, fields=params, body=data, headers=headers)
-        except (urllib3.exceptions.NewConnectionError, urllib3.exceptions.SSLError,
-                urllib3.exceptions.MaxRetryError) as e:
-            print('ERROR: The address "' + url + '" is invalid')
-            return '["ERROR:", "   Invalid URL!"]'
+            response = self._send(method, url, params, data, headers, deadline, **stream)
+        except urllib3.exceptions.HTTPError as e:
+            if deadline is not None:
+                deadline.check()
+            # structured clients report every transport error, others keep raising the ones they always did
+            if not self.structured and not isinstance(e, (urllib3.exceptions.NewConnectionError,
+                                                          urllib3.exceptions.SSLError,
+                                                          urllib3.exceptions.MaxRetryError,
+                                                          urllib3.exceptions.TimeoutError)):
+                raise
+            return self._requestFailed(url, e)
         else:
-            return self.handleResponse(response, url)
+            with self.phase("decode", url):
+                return self.handleResponse(response, url, out)
+
+    def _requestFailed(self, url, error):
+        if isinstance(error, urllib3.exceptions.MaxRetryError) and error.reason is not None:
+            error = error.reason
+        # NewConnectionError is a ConnectTimeoutError, but a refused connection is not a timeout
+        timed_out = isinstance(error, urllib3.exceptions.TimeoutError) and \
+            not isinstance(error, urllib3.exceptions.NewConnectionError)
+        if self.structured:
+            logger.debug("Request to %s failed: %r", url, error)
+            if timed_out:
+                raise PicSureHttpError(None, "Timed out", url)
+            if isinstance(error, urllib3.exceptions.ProtocolError):
+                raise PicSureHttpError(None, "Connection lost", url)
+            raise PicSureHttpError(None, "Invalid URL!", url)
+        if timed_out:
+            print('ERROR: The request to "' + url + '" timed out')
+            return '["ERROR:", "   Timed out"]'
+        print('ERROR: The address "' + url + '" is invalid')
+        return '["ERROR:", "   Invalid URL!"]'
+
+    def _routedRequest(self, method, path, params=None, data=None, deadline=None, out=None):
+        # try the fastest healthy endpoint first and fail over on connection errors or 5xx responses.
+        # A POST may not be idempotent (it can submit a query) so it only fails over when the connection
+        # could not be made, never once the request may have reached the server.
+        headers = self.setHeaders()
+        stream = {} if out is None else {'preload_content': False}
+        self.endpoints.routeStarted()
+        base_urls = self.endpoints.ordered()
+        idempotent = method != 'POST'
+        for base_url in base_urls:
+            url = base_url + path
+            try:
+                response = self._send(method, url, params, data, headers, deadline, retries=False, **stream)
+            except urllib3.exceptions.HTTPError as e:
+                if deadline is not None:
+                    deadline.check()
+                self.endpoints.recordFailure(base_url)
+                if idempotent or isinstance(e, (urllib3.exceptions.NewConnectionError,
+                                                urllib3.exceptions.ConnectTimeoutError)):
+                    logger.debug("Request to %s failed, trying the next endpoint: %r", url, e)
+                    continue
+                return self._requestFailed(url, e)
+            if response.status >= 500:
+                self.endpoints.recordFailure(base_url)
+                if idempotent and base_url != base_urls[-1]:
+                    response.drain_conn()
+                    continue
+            else:
+                self.endpoints.recordSuccess(base_url)
+            with self.phase("decode", url):
+                return self.handleResponse(response, url, out)
+        if self.structured:
+            raise PicSureHttpError(None, "No endpoint could be reached", ", ".join(base_urls))
+        print('ERROR: None of the addresses "' + '", "'.join(base_urls) + '" could be reached')
+        return '["ERROR:", "   Invalid URL!"]'
 
     def setHeaders(self):
         return {'Authorization': 'Bearer ' + self.token, 'Content-Type': 'application/json'}
 
-    def handleResponse(self, response, url):
+    def handleResponse(self, response, url, out=None):
         if response.status != 200:
             result = {"result": {}, "error": True}
             if response.status == 401:
@@ -319,6 +785,13 @@ class PicSureHttpClient:
                 result["message"] = "Invalid URL"
 
             result["status"] = response.status
+            if out is not None:
+                # a streamed response keeps its connection until the body is read
+                response.drain_conn()
+
+            if self.structured:
+                logger.debug("HTTP %s from %s: %s", response.status, url, result.get("message"))
+                raise PicSureHttpError(response.status, result.get("message", "HTTP error"), url)
 
             # These error messages are used in unit tests, so don't change them without updating the tests.
             print("ERROR: " + (result["message"] if "message" in result else ""))
@@ -327,5 +800,20 @@ class PicSureHttpClient:
             print(response.headers)
 
             return result
+        elif out is not None:
+            return self._streamResponse(response, url, out)
         else:
             return response.data.decode('utf-8')
+
+    def _streamResponse(self, response, url, out):
+        """ Copies the body of a response requested with preload_content=False into out, returns its size """
+        written = 0
+        try:
+            for chunk in response.stream(STREAM_CHUNK_SIZE):
+                out.write(chunk)
+                written += len(chunk)
+        except urllib3.exceptions.HTTPError as e:
+            return self._requestFailed(url, e)
+        finally:
+            response.release_conn()
+        return written
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""Health checked pool of equivalent PIC-SURE endpoints"""
+import threading
+import time
+
+import urllib3
+
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.latency = None
+        self.failures = 0
+
+    def __repr__(self):
+        return "Endpoint(%r, healthy=%r, latency=%r)" % (self.url, self.healthy, self.latency)
+
+
+class EndpointPool:
+    """ Tracks health and a moving average probe latency for a list of equivalent base URLs """
+    def __init__(self, urls, token=None, allowSelfSigned=False, probePath="info/resources", interval=30.0,
+                 alpha=0.3, probeTimeout=5.0, autostart=False):
+        if len(urls) == 0:
+            raise ValueError("EndpointPool needs at least one URL")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.token = token
+        self.probePath = probePath
+        self.interval = interval
+        self.alpha = alpha
+        self.probeTimeout = probeTimeout
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._autostart = autostart
+        if allowSelfSigned is True:
+            self.http = urllib3.PoolManager(cert_reqs='CERT_NONE')
+        else:
+            self.http = urllib3.PoolManager()
+
+    @property
+    def urls(self):
+        return [endpoint.url for endpoint in self.endpoints]
+
+    def _find(self, url):
+        for endpoint in self.endpoints:
+            if endpoint.url == url:
+                return endpoint
+        raise KeyError(url)
+
+    def ordered(self):
+        """ Returns the URLs with healthy endpoints first, fastest first; unmeasured endpoints keep list order """
+        with self._lock:
+            ranked = sorted(enumerate(self.endpoints),
+                            key=lambda item: (not item[1].healthy,
+                                              item[1].latency is None,
+                                              item[1].latency or 0.0,
+                                              item[0]))
+            return [endpoint.url for index, endpoint in ranked]
+
+    def best(self):
+        return self.ordered()[0]
+
+    def routeStarted(self):
+        """ Called before a request is routed, starts the health checks of an autostart pool """
+        with self._lock:
+            if not self._autostart:
+                return
+            self._autostart = False
+        self.start()
+
+    def state(self):
+        """ Returns the health and latency of every endpoint, see restoreState() """
+        with self._lock:
+            return [{"url": e.url, "healthy": e.healthy, "latency": e.latency} for e in self.endpoints]
+
+    def restoreState(self, states):
+        with self._lock:
+            for state in states:
+                for endpoint in self.endpoints:
+                    if endpoint.url == state["url"]:
+                        endpoint.healthy = state["healthy"]
+                        endpoint.latency = state["latency"]
+
+    def recordSuccess(self, url, latency=None):
+        with self._lock:
+            endpoint = self._find(url)
+            endpoint.healthy = True
+            endpoint.failures = 0
+            if latency is None:
+                return
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency = self.alpha * latency + (1 - self.alpha) * endpoint.latency
+
+    def recordFailure(self, url):
+        with self._lock:
+            endpoint = self._find(url)
+            endpoint.healthy = False
+            endpoint.failures += 1
+
+    def probe(self, url):
+        """ An endpoint is up if it answers the probe without a connection error or a 5xx status """
+        headers = {'Content-Type': 'application/json'}
+        if self.token is not None:
+            headers['Authorization'] = 'Bearer ' + self.token
+        start = time.perf_counter()
+        try:
+            response = self.http.request('GET', url + self.probePath, headers=headers, retries=False,
+                                         timeout=self.probeTimeout)
+        except urllib3.exceptions.HTTPError:
+            self.recordFailure(url)
+            return False
+        if response.status >= 500:
+            self.recordFailure(url)
+            return False
+        self.recordSuccess(url, time.perf_counter() - start)
+        return True
+
+    def checkAll(self):
+        for url in self.urls:
+            if self._stop.is_set():
+                return
+            self.probe(url)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.checkAll()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """ Starts the background health checks, the first round runs immediately """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="PicSureEndpointPool", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._autostart = False
+        self._stop.set()
+        # stop() can run on the health check thread itself when it triggers garbage collection
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(self.probeTimeout)
+        self._thread = None
+        self.http.clear()
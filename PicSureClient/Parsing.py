@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""Parallel parsing of CSV query results"""
+import csv
+import io
+import multiprocessing
+import os
+import sys
+from bisect import bisect_right
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import zip_longest
+
+
+class ChunkedColumn:
+    """ Read-only sequence over the per-chunk lists of one column, the chunks are never concatenated """
+    def __init__(self, parts):
+        self.parts = parts
+        self._offsets = []
+        total = 0
+        for part in parts:
+            self._offsets.append(total)
+            total += len(part)
+        self._length = total
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for part in self.parts:
+            yield from part
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if index < 0 or index >= self._length:
+            raise IndexError("column index out of range")
+        part = bisect_right(self._offsets, index) - 1
+        return self.parts[part][index - self._offsets[part]]
+
+    def __repr__(self):
+        return "ChunkedColumn(%d values in %d chunks)" % (self._length, len(self.parts))
+
+
+def _rowEnd(text, start, quotes_pos, quotes):
+    """ Returns (offset after the first newline at or after start that is not inside a quoted field,
+        position and count of quotes seen so far), or -1 for the offset when no such newline exists """
+    newline = text.find("\n", start)
+    while newline != -1:
+        quotes += text.count('"', quotes_pos, newline)
+        quotes_pos = newline
+        if quotes % 2 == 0:
+            return newline + 1, quotes_pos, quotes
+        newline = text.find("\n", newline + 1)
+    return -1, quotes_pos, quotes
+
+
+def splitRows(text, chunks, start=0):
+    """ Returns (begin, end) offsets cutting text[start:] into about `chunks` pieces on row boundaries """
+    size = max(1, (len(text) - start) // chunks)
+    bounds = [start]
+    quotes_pos = start
+    quotes = 0
+    for i in range(1, chunks):
+        target = max(start + i * size, bounds[-1])
+        end, quotes_pos, quotes = _rowEnd(text, target, quotes_pos, quotes)
+        if end == -1 or end >= len(text):
+            break
+        if end > bounds[-1]:
+            bounds.append(end)
+    bounds.append(len(text))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _parseChunk(chunk, width):
+    # csv.reader returns an empty row for a blank line, which is not a row of the result
+    rows = (row for row in csv.reader(io.StringIO(chunk, newline='')) if row)
+    columns = [list(column) for column in zip_longest(*rows, fillvalue="")]
+    columns = columns[:width]
+    while len(columns) < width:
+        columns.append([""] * (len(columns[0]) if columns else 0))
+    return columns
+
+
+def _cpuCount():
+    """ Number of CPUs this process may run on, which can be fewer than os.cpu_count() """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _processPool(workers):
+    # forked workers would inherit the locks of running threads (health checks, prefetch), start fresh ones
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    if sys.version_info < (3, 7):
+        return ProcessPoolExecutor(max_workers=workers)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+
+
+def parseCsv(text, processes=None, min_chunk_size=1 << 20):
+    """ Parses a CSV result into a dict of column name -> ChunkedColumn of strings.
+
+        Rows are cut into a few chunks per process only as workers free up, and parsed in a process pool;
+        with one process, or less than min_chunk_size characters, they are parsed in the calling process.
+        The parent still unpickles every parsed chunk, so the speedup is less than the number of cores.
+    """
+    header_end, quotes_pos, quotes = _rowEnd(text, 0, 0, 0)
+    if header_end == -1:
+        header_end = len(text)
+    header = next(csv.reader(io.StringIO(text[:header_end], newline='')), [])
+    width = len(header)
+
+    processes = processes or _cpuCount()
+    chunks = 1 if processes == 1 else max(1, min(processes * 4, (len(text) - header_end) // max(1, min_chunk_size)))
+    bounds = splitRows(text, chunks, header_end)
+    if len(bounds) == 1:
+        parsed = [_parseChunk(text[header_end:], width)]
+    else:
+        workers = min(processes, len(bounds))
+        futures = []
+        with _processPool(workers) as executor:
+            running = set()
+            for begin, end in bounds:
+                if len(running) >= workers:
+                    _, running = wait(running, return_when=FIRST_COMPLETED)
+                future = executor.submit(_parseChunk, text[begin:end], width)
+                futures.append(future)
+                running.add(future)
+            parsed = [future.result() for future in futures]
+    return {name: ChunkedColumn([columns[i] for columns in parsed]) for i, name in enumerate(header)}
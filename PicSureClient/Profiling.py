@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""Time and memory profiling of request phases"""
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class RequestProfiler:
+    """ Records wall time and net traced bytes and blocks of each request phase, and the process peak """
+    def __init__(self):
+        self.records = []
+        self.peak_bytes = None
+        self._lock = threading.Lock()
+        self._started_tracing = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+
+    def stop(self):
+        self.peak()
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def peak(self):
+        """ Highest memory traced in the whole process since tracing started, kept after stop() """
+        if tracemalloc.is_tracing():
+            self.peak_bytes = tracemalloc.get_traced_memory()[1]
+        return self.peak_bytes
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @contextmanager
+    def phase(self, name, url=None):
+        # the traced memory is process wide, phases running at the same time count each other's allocations
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            before = tracemalloc.get_traced_memory()[0]
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {"phase": name, "url": url, "seconds": time.perf_counter() - start,
+                      "net_blocks": sys.getallocatedblocks() - blocks, "net_bytes": None}
+            if tracing and tracemalloc.is_tracing():
+                record["net_bytes"] = tracemalloc.get_traced_memory()[0] - before
+            with self._lock:
+                self.records.append(record)
+
+    def summary(self):
+        """ Returns {phase: {"count", "seconds", "max_net_bytes", "net_blocks"}} over all recorded requests """
+        phases = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            totals = phases.setdefault(record["phase"], {"count": 0, "seconds": 0.0, "max_net_bytes": 0,
+                                                         "net_blocks": 0})
+            totals["count"] += 1
+            totals["seconds"] += record["seconds"]
+            totals["net_blocks"] += record["net_blocks"]
+            if record["net_bytes"] is not None:
+                totals["max_net_bytes"] = max(totals["max_net_bytes"], record["net_bytes"])
+        return phases
+
+    def report(self):
+        lines = ["Phase".ljust(10) + "Count".rjust(8) + "Seconds".rjust(12) + "Max net MB".rjust(12)
+                 + "Net blocks".rjust(12)]
+        for name, totals in self.summary().items():
+            lines.append(name.ljust(10) + str(totals["count"]).rjust(8) + ("%.3f" % totals["seconds"]).rjust(12)
+                         + ("%.2f" % (totals["max_net_bytes"] / 1048576.0)).rjust(12)
+                         + str(totals["net_blocks"]).rjust(12))
+        peak = self.peak()
+        if peak is not None:
+            lines.append("Process peak: %.2f MB" % (peak / 1048576.0))
+        return "\n".join(lines)
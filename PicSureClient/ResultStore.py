@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""Column oriented, memory-mapped on-disk store for parsed query results
+
+File layout: MAGIC, one 8-byte aligned block per column, a JSON footer describing the blocks,
+the footer length as a little-endian uint64, and MAGIC again.  Numeric columns are stored as
+float64 (empty values become NaN).  Any other column is dictionary-encoded: int32 codes, int64
+offsets into the dictionary and the dictionary's UTF-8 bytes.  A column is only stored as
+numbers when every value is written exactly as the float prints it back (so "02115", "1e5",
+"nan" or a 20 digit identifier stay strings).  Blocks are written in the writer's native
+byte order, which is recorded in the footer.
+"""
+import json
+import math
+import mmap
+import struct
+import sys
+from array import array
+
+MAGIC = b"PICSURE1"
+ALIGNMENT = 8
+
+
+def _isExactFloat(value):
+    """ True when value converts to a finite float and back to the same text """
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, float)):
+        return math.isfinite(value) and float(value) == value and abs(value) <= 2 ** 53
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return False
+    if not math.isfinite(number):
+        return False
+    if number.is_integer() and abs(number) <= 2 ** 53 and value == str(int(number)):
+        return True
+    return value == repr(number)
+
+
+def _isNumeric(values):
+    for value in values:
+        if value is None or value == "":
+            continue
+        if not _isExactFloat(value):
+            return False
+    return True
+
+
+def _toFloat(value):
+    if value is None or value == "":
+        return math.nan
+    return float(value)
+
+
+def _writeBlock(out, data):
+    """ Writes one block at the next aligned offset and returns (offset, length) """
+    padding = -out.tell() % ALIGNMENT
+    if padding:
+        out.write(b"\0" * padding)
+    offset = out.tell()
+    out.write(data)
+    return offset, len(data)
+
+
+def saveResult(path, columns):
+    """ Writes a dict of column name -> sequence of values (as returned by parseCsv) to path """
+    footer = {"byteorder": sys.byteorder, "rows": None, "columns": []}
+    with open(path, 'wb') as out:
+        out.write(MAGIC)
+        for name, values in columns.items():
+            if footer["rows"] is None:
+                footer["rows"] = len(values)
+            elif len(values) != footer["rows"]:
+                raise ValueError("column %r has %d rows, expected %d" % (name, len(values), footer["rows"]))
+
+            if _isNumeric(values):
+                offset, length = _writeBlock(out, array('d', (_toFloat(value) for value in values)).tobytes())
+                footer["columns"].append({"name": name, "type": "float64", "offset": offset, "length": length})
+                continue
+
+            index = {}
+            codes = array('i', (index.setdefault(str(value), len(index)) for value in values))
+            encoded = [entry.encode('utf-8') for entry in index]
+            offsets = array('q', [0])
+            for entry in encoded:
+                offsets.append(offsets[-1] + len(entry))
+            column = {"name": name, "type": "dictionary", "size": len(encoded)}
+            column["codes"] = _writeBlock(out, codes.tobytes())
+            column["offsets"] = _writeBlock(out, offsets.tobytes())
+            column["data"] = _writeBlock(out, b"".join(encoded))
+            footer["columns"].append(column)
+
+        footer["rows"] = footer["rows"] or 0
+        encoded_footer = json.dumps(footer).encode('utf-8')
+        out.write(encoded_footer)
+        out.write(struct.pack("<Q", len(encoded_footer)))
+        out.write(MAGIC)
+
+
+class DictionaryColumn:
+    """ Lazily decoded view of a dictionary-encoded string column """
+    def __init__(self, codes, offsets, data, size):
+        self.codes = codes
+        self._offsets = offsets
+        self._data = data
+        self._decoded = [None] * size
+
+    def entry(self, code):
+        value = self._decoded[code]
+        if value is None:
+            value = str(self._data[self._offsets[code]:self._offsets[code + 1]], 'utf-8')
+            self._decoded[code] = value
+        return value
+
+    @property
+    def dictionary(self):
+        return [self.entry(code) for code in range(len(self._decoded))]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        for code in self.codes:
+            yield self.entry(code)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.entry(code) for code in self.codes[index]]
+        return self.entry(self.codes[index])
+
+    def release(self):
+        self.codes.release()
+        self._offsets.release()
+        self._data.release()
+
+
+class StoredResult:
+    """ A result file opened with mmap, columns are views on the shared pages and nothing is parsed up front """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("%s is not a PIC-SURE result file" % path)
+        self._view = memoryview(self._map)
+        self._columns = {}
+        try:
+            self._readFooter()
+        except Exception:
+            self.close()
+            raise
+
+    def _readFooter(self):
+        size = len(self._map)
+        if size < 2 * len(MAGIC) + 8 or self._map[:len(MAGIC)] != MAGIC or self._map[-len(MAGIC):] != MAGIC:
+            raise ValueError("%s is not a PIC-SURE result file" % self.path)
+        footer_end = size - len(MAGIC) - 8
+        (footer_length,) = struct.unpack("<Q", self._map[footer_end:footer_end + 8])
+        footer = json.loads(self._map[footer_end - footer_length:footer_end].decode('utf-8'))
+        if footer["byteorder"] != sys.byteorder:
+            raise ValueError("%s was written on a %s-endian machine" % (self.path, footer["byteorder"]))
+        self.rows = footer["rows"]
+        self._specs = {column["name"]: column for column in footer["columns"]}
+
+    def _block(self, block, fmt):
+        offset, length = block
+        return self._view[offset:offset + length].cast(fmt)
+
+    def __getitem__(self, name):
+        column = self._columns.get(name)
+        if column is None:
+            spec = self._specs[name]
+            if spec["type"] == "float64":
+                column = self._block((spec["offset"], spec["length"]), 'd')
+            else:
+                column = DictionaryColumn(self._block(spec["codes"], 'i'), self._block(spec["offsets"], 'q'),
+                                          self._block(spec["data"], 'B'), spec["size"])
+            self._columns[name] = column
+        return column
+
+    def __contains__(self, name):
+        return name in self._specs
+
+    def __iter__(self):
+        return iter(self._specs)
+
+    def __len__(self):
+        return len(self._specs)
+
+    def keys(self):
+        return list(self._specs)
+
+    def close(self):
+        """ Unmaps the file.  If slices of a column are still referenced the mapping is left for the
+            garbage collector to close once they are gone, so those slices stay readable. """
+        columns, self._columns = self._columns, {}
+        try:
+            for column in columns.values():
+                column.release()
+            self._view.release()
+            self._map.close()
+        except BufferError:
+            pass
+        self._view = None
+        self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def openResult(path):
+    return StoredResult(path)
@@ -9,3 +9,14 @@ __version__ = '1.1.0'
 from .Connection import Client
 from .Connection import Connection
 from .Connection import PicSureConnectionAPI
+from .Connection import PicSureClientException
+from .Connection import PicSureHttpError
+from .Connection import Deadline
+from .Connection import FederatedResult
+from .Connection import DeadlineExceeded
+from .Endpoints import EndpointPool
+from .Parsing import parseCsv
+from .ResultStore import saveResult
+from .ResultStore import openResult
+from .Profiling import RequestProfiler
+from .Concurrency import ConcurrencyLimiter
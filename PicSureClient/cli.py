@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""Command line interface for running batches of PIC-SURE queries"""
+import argparse
+import codecs
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import PicSureClient
+
+FORMATS = {"raw": ".txt", "jsonl": ".jsonl"}
+
+# bytes copied at a time from a streamed result into results.jsonl
+COPY_CHUNK_SIZE = 1 << 16
+
+
+def readQueries(path, resource_uuid=None):
+    """ Reads queries from a file holding either a JSON array or one JSON query per line """
+    with open(path, 'r') as query_file:
+        text = query_file.read()
+    if text.lstrip().startswith("["):
+        queries = json.loads(text)
+    else:
+        queries = [json.loads(line) for line in text.splitlines()
+                   if line.strip() and not line.lstrip().startswith("#")]
+    if resource_uuid is not None:
+        for query in queries:
+            query["resourceUUID"] = resource_uuid
+    return queries
+
+
+def percentile(sorted_values, pct):
+    if len(sorted_values) == 0:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class ResultWriter:
+    """ Streams each result to disk while its query runs, jsonl results are appended once complete """
+    def __init__(self, output_dir, fmt):
+        self.output_dir = output_dir
+        self.format = fmt
+        self._lock = threading.Lock()
+        self._jsonl = None
+        os.makedirs(output_dir, exist_ok=True)
+        if fmt == "jsonl":
+            self._jsonl = open(os.path.join(output_dir, "results" + FORMATS[fmt]), 'w')
+
+    def open(self, index):
+        """ Returns the binary file the result of query `index` is streamed into """
+        if self._jsonl is not None:
+            return tempfile.TemporaryFile(dir=self.output_dir)
+        return open(os.path.join(self.output_dir, "query-%05d%s" % (index, FORMATS[self.format])), 'wb')
+
+    def write(self, index, body, elapsed, error):
+        """ Finishes a result streamed into body (from open()) and closes it """
+        with body:
+            if self._jsonl is None:
+                return
+            body.seek(0)
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            # the result is escaped a chunk at a time so it is never held in memory whole
+            with self._lock:
+                self._jsonl.write('{"index": %s, "error": %s, "elapsed": %s, "result": "'
+                                  % (json.dumps(index), json.dumps(error), json.dumps(elapsed)))
+                for chunk in iter(lambda: body.read(COPY_CHUNK_SIZE), b""):
+                    self._jsonl.write(json.dumps(decoder.decode(chunk))[1:-1])
+                self._jsonl.write(json.dumps(decoder.decode(b"", final=True))[1:-1] + '"}\n')
+                self._jsonl.flush()
+
+    def close(self):
+        if self._jsonl is not None:
+            self._jsonl.close()
+
+
+def runQueries(api, queries, writer, parallel=4, timeout=None):
+    """ Runs all queries through syncQuery using a pool of worker threads, returns (latencies, failures) """
+    def run(index, query):
+        start = time.perf_counter()
+        body = writer.open(index)
+        try:
+            deadline = None if timeout is None else PicSureClient.Deadline(timeout)
+            api.syncQuery(query.get("resourceUUID"), json.dumps(query), deadline=deadline, out=body)
+            error = False
+        except Exception as e:
+            # one failing query must not stop the batch, record it in place of the result and carry on
+            body.seek(0)
+            body.truncate()
+            body.write(json.dumps({"error": True, "status": getattr(e, "status", None), "message": str(e)})
+                       .encode('utf-8'))
+            error = True
+        elapsed = time.perf_counter() - start
+        writer.write(index, body, elapsed, error)
+        return elapsed, error
+
+    latencies = []
+    failures = 0
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [executor.submit(run, index, query) for index, query in enumerate(queries, 1)]
+        for future in as_completed(futures):
+            elapsed, error = future.result()
+            latencies.append(elapsed)
+            if error:
+                failures += 1
+    return latencies, failures
+
+
+def printSummary(latencies, failures, wall_time, out=None, concurrency=None):
+    out = sys.stdout if out is None else out
+    ordered = sorted(latencies)
+    total = len(ordered)
+    throughput = total / wall_time if wall_time > 0 else 0.0
+    mean = sum(ordered) / total if total > 0 else 0.0
+    out.write("+".ljust(39, '-') + "+\n")
+    out.write("|  Queries run: %d (%d failed)\n" % (total, failures))
+    out.write("|  Wall time:   %.3fs\n" % wall_time)
+    out.write("|  Throughput:  %.2f queries/s\n" % throughput)
+    if total > 0:
+        out.write("|  Latency:     min %.3fs  mean %.3fs  p50 %.3fs  p95 %.3fs  max %.3fs\n"
+                  % (ordered[0], mean, percentile(ordered, 50), percentile(ordered, 95), ordered[-1]))
+    if concurrency is not None:
+        metrics = concurrency.metrics()
+        out.write("|  Concurrency: final limit %d (%d back-offs)\n" % (metrics["limit"], metrics["decreases"]))
+    out.write("+".ljust(39, '-') + "+\n")
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(prog="picsure", description="Run a file of PIC-SURE queries in bulk.")
+    parser.add_argument("queries", help="file holding a JSON array of queries or one JSON query per line")
+    parser.add_argument("--url", required=True, help="PIC-SURE API endpoint")
+    parser.add_argument("--token", default=os.environ.get("PICSURE_TOKEN"),
+                        help="security token (defaults to $PICSURE_TOKEN)")
+    parser.add_argument("--token-file", help="read the security token from this file")
+    parser.add_argument("--resource", help="resource UUID to set on every query")
+    parser.add_argument("--parallel", type=int, default=4, help="number of queries to run at once (default 4)")
+    parser.add_argument("--output-dir", default="picsure-results", help="directory results are written to")
+    parser.add_argument("--format", choices=sorted(FORMATS.keys()), default="raw",
+                        help="raw writes each response body to its own file, jsonl appends every result to one file")
+    parser.add_argument("--timeout", type=float, help="give up on a query after this many seconds")
+    parser.add_argument("--connect-timeout", type=float, help="seconds to wait for a connection to the server")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="adjust the number of requests in flight to server latency, up to --parallel")
+    parser.add_argument("--allow-self-signed", action="store_true", help="accept self-signed SSL certificates")
+    return parser
+
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+    token = args.token
+    if args.token_file is not None:
+        with open(args.token_file, 'r') as token_file:
+            token = token_file.read().strip()
+    if not token:
+        sys.stderr.write("ERROR: a token is required, use --token, --token-file or $PICSURE_TOKEN\n")
+        return 2
+    if args.parallel < 1:
+        sys.stderr.write("ERROR: --parallel must be at least 1\n")
+        return 2
+
+    queries = readQueries(args.queries, args.resource)
+    concurrency = None
+    if args.adaptive:
+        concurrency = PicSureClient.ConcurrencyLimiter(initial=min(4, args.parallel), maximum=args.parallel)
+    try:
+        connection = PicSureClient.Client.connect(args.url, token, args.allow_self_signed,
+                                                  connect_timeout=args.connect_timeout, structured=True,
+                                                  concurrency=concurrency, pool_size=args.parallel)
+    except PicSureClient.PicSureClientException as e:
+        sys.stderr.write("ERROR: could not connect, %s\n" % e)
+        return 1
+    api = connection._api_obj()
+
+    writer = ResultWriter(args.output_dir, args.format)
+    start = time.perf_counter()
+    try:
+        latencies, failures = runQueries(api, queries, writer, args.parallel, args.timeout)
+    finally:
+        writer.close()
+    printSummary(latencies, failures, time.perf_counter() - start, concurrency=concurrency)
+    return 1 if failures > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
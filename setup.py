@@ -26,14 +26,22 @@ setup(
         'License :: OSI Approved :: Apache Software License',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
+    entry_points={
+        'console_scripts': [
+            'picsure=PicSureClient.cli:main',
+        ],
+    },
     description="PIC-SURE API Base Client Library which can be used by research users to connect to a PIC-SURE API and list resource instances and their metadata.",
     install_requires=requirements,
     license="Apache Software License 2.0",
+    python_requires='>=3.6',
     long_description=readme + '\n\n' + history,
     include_package_data=True,
     keywords='PicSureClient',
@@ -2,14 +2,25 @@
 # -*- coding: utf-8 -*-
 
 """Tests for `PicSureClient` package."""
+import csv
+import gc
 import io
 import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 from contextlib import contextmanager
 from unittest.mock import patch, MagicMock
 
 import urllib3
 import PicSureClient
+import PicSureClient.Cache
+import PicSureClient.Parsing
+import PicSureClient.cli
 
 
 @contextmanager
@@ -27,6 +38,13 @@ def capture_stdout(assert_callback=None):
             assert_callback(captured)
 
 
+def fake_response(data, status=200):
+    """ A real, unread urllib3 response so both response.data and response.stream() work """
+    if isinstance(data, str):
+        data = data.encode()
+    return urllib3.response.HTTPResponse(body=io.BytesIO(data), status=status, headers={}, preload_content=False)
+
+
 class TestClient(unittest.TestCase):
 
     def setUp(self):
@@ -221,6 +239,11 @@ class TestConnectionAPI(unittest.TestCase):
         self.assertEqual(test_api_obj.AllowSelfSigned, False,
                          "Accepting self-signed SSL certificates should NOT be the default!")
 
+    def test_connection_api_pool_size(self):
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url_picsure, self.test_url_psama, self.test_token,
+                                                          pool_size=16)
+        self.assertEqual(16, test_api_obj.picsureHttpConnect.http.connection_pool_kw["maxsize"])
+
     @patch('urllib3.PoolManager.request')
     def test_connectionapi_func_profile(self, mock_request):
         resource_info = {"uuid": self.test_uuid, "email": "some@email.edu",
@@ -347,3 +370,683 @@ class TestConnectionAPI(unittest.TestCase):
         self.assertEqual(json_content, test_info)
         mock_http.assert_called_with("POST", self.test_url_picsure + "query/" + test_query_uuid + "/result",
                                      fields=None, body=test_query_json, headers=self.mock_response.headers)
+
+
+class TestCli(unittest.TestCase):
+
+    def setUp(self):
+        self.test_url = "http://some.url/PIC-SURE/"
+        self.test_token = "some_security_token"
+        self.tmp_dir = tempfile.mkdtemp()
+        self.query_file = os.path.join(self.tmp_dir, "queries.jsonl")
+        with open(self.query_file, 'w') as f:
+            f.write(json.dumps({"query": {"fields": []}}) + "\n")
+            f.write("# comment lines are skipped\n")
+            f.write(json.dumps({"query": {"fields": ["\\some\\path\\"]}}) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cli_read_queries_sets_resource(self):
+        queries = PicSureClient.cli.readQueries(self.query_file, "some_resource_uuid")
+        self.assertEqual(2, len(queries))
+        self.assertTrue(all(q["resourceUUID"] == "some_resource_uuid" for q in queries))
+
+    @patch('urllib3.PoolManager.request')
+    def test_cli_main_writes_results_and_summary(self, mock_request):
+        mock_request.side_effect = lambda *args, **kwargs: fake_response('["SOME-RESOURCE-UUID-HERE"]')
+        output_dir = os.path.join(self.tmp_dir, "out")
+
+        assertion = lambda captured: self.assertTrue(captured.index("Throughput") > 0, "Should print a summary")
+        with capture_stdout(assertion):
+            ret = PicSureClient.cli.main([self.query_file, "--url", self.test_url, "--token", self.test_token,
+                                          "--parallel", "2", "--output-dir", output_dir, "--format", "jsonl"])
+        self.assertEqual(0, ret)
+        with open(os.path.join(output_dir, "results.jsonl")) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([1, 2], sorted(line["index"] for line in lines))
+        self.assertEqual(['["SOME-RESOURCE-UUID-HERE"]'] * 2, [line["result"] for line in lines])
+        self.assertEqual(3, mock_request.call_count)
+
+    @patch('urllib3.PoolManager.request')
+    def test_cli_main_streams_raw_results(self, mock_request):
+        result = "Patient ID,\\demographics\\AGE\\\n" + "1,42\n" * 50000
+        mock_request.side_effect = lambda method, url, **kwargs: fake_response(
+            result if url.endswith("query/sync") else '["SOME-RESOURCE-UUID-HERE"]')
+        output_dir = os.path.join(self.tmp_dir, "out")
+
+        with capture_stdout():
+            ret = PicSureClient.cli.main([self.query_file, "--url", self.test_url, "--token", self.test_token,
+                                          "--parallel", "2", "--output-dir", output_dir])
+        self.assertEqual(0, ret)
+        with open(os.path.join(output_dir, "query-00002.txt")) as f:
+            self.assertEqual(result, f.read())
+        self.assertFalse(mock_request.call_args[1]["preload_content"], "Results should be streamed to disk")
+
+    @patch('urllib3.PoolManager.request')
+    def test_cli_survives_connection_reset(self, mock_request):
+        def fake_request(method, url, body=None, **kwargs):
+            if body is not None and json.loads(body)["query"]["fields"]:
+                raise urllib3.exceptions.ProtocolError("Connection aborted.")
+            return fake_response('["SOME-RESOURCE-UUID-HERE"]')
+        mock_request.side_effect = fake_request
+        output_dir = os.path.join(self.tmp_dir, "out")
+
+        assertion = lambda captured: self.assertTrue(captured.index("2 (1 failed)") > 0)
+        with capture_stdout(assertion):
+            ret = PicSureClient.cli.main([self.query_file, "--url", self.test_url, "--token", self.test_token,
+                                          "--output-dir", output_dir, "--format", "jsonl"])
+        self.assertEqual(1, ret)
+        with open(os.path.join(output_dir, "results.jsonl")) as f:
+            failed = [line for line in map(json.loads, f) if line["error"]]
+        self.assertEqual([2], [line["index"] for line in failed])
+        self.assertIn("Connection lost", failed[0]["result"])
+
+
+class TestEndpointPool(unittest.TestCase):
+
+    def setUp(self):
+        self.test_urls = ["http://region-a.url/PIC-SURE/", "http://region-b.url/PIC-SURE/"]
+        self.test_token = "some_security_token"
+
+        self.mock_response = MagicMock(spec=urllib3.response.HTTPResponse)
+        self.mock_response.status = 200
+        self.mock_response.data = '["SOME-RESOURCE-UUID-HERE"]'.encode()
+
+    def test_endpoint_pool_orders_by_health_and_latency(self):
+        pool = PicSureClient.EndpointPool(self.test_urls)
+        self.assertEqual(self.test_urls, pool.ordered(), "Unmeasured endpoints should keep their list order")
+        pool.recordSuccess(self.test_urls[0], 0.5)
+        pool.recordSuccess(self.test_urls[1], 0.1)
+        self.assertEqual(self.test_urls[1], pool.best())
+        pool.recordFailure(self.test_urls[1])
+        self.assertEqual(self.test_urls[0], pool.best())
+
+    @patch('urllib3.PoolManager.request')
+    def test_endpoint_pool_fails_over(self, mock_request):
+        def fake_request(method, url, **kwargs):
+            if url.startswith(self.test_urls[0]):
+                raise urllib3.exceptions.NewConnectionError(None, "region down")
+            return self.mock_response
+        mock_request.side_effect = fake_request
+
+        test_conn = PicSureClient.Client.connect(self.test_urls, self.test_token, health_check_interval=3600)
+        test_conn.close()
+        self.assertEqual(self.mock_response.data.decode(), test_conn.getResources())
+        self.assertEqual(self.test_urls[1], test_conn.endpoints.best())
+        self.assertEqual(test_conn._api_obj().picsureHttpConnect.endpoints, test_conn.endpoints)
+
+    @patch('urllib3.PoolManager.request')
+    def test_endpoint_pool_stops_with_connection(self, mock_request):
+        mock_request.return_value = self.mock_response
+        with PicSureClient.Client.connect(self.test_urls, self.test_token, health_check_interval=3600) as test_conn:
+            pool = test_conn.endpoints
+            self.assertTrue(pool._thread.is_alive(), "Connecting routes a request, which starts the health checks")
+        self.assertIsNone(pool._thread)
+
+        test_conn = PicSureClient.Client.connect(self.test_urls, self.test_token, health_check_interval=3600)
+        thread = test_conn.endpoints._thread
+        del test_conn
+        gc.collect()
+        thread.join(1)
+        self.assertFalse(thread.is_alive(), "Dropping the connection should stop its health checks")
+
+    @patch('urllib3.PoolManager.request')
+    def test_endpoint_pool_does_not_resend_posts(self, mock_request):
+        mock_request.side_effect = urllib3.exceptions.ProtocolError("connection reset")
+        pool = PicSureClient.EndpointPool(self.test_urls)
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_urls[0], self.test_urls[0], self.test_token,
+                                                          structured=True, endpoints=pool)
+        with self.assertRaises(PicSureClient.PicSureHttpError):
+            test_api_obj.asyncQuery("some_resource_uuid", '{"query": {}}')
+        self.assertEqual(1, mock_request.call_count, "A query that may have been submitted must not be resent")
+
+        self.mock_response.status = 503
+        mock_request.side_effect = None
+        mock_request.return_value = self.mock_response
+        mock_request.reset_mock()
+        with self.assertRaises(PicSureClient.PicSureHttpError):
+            test_api_obj.asyncQuery("some_resource_uuid", '{"query": {}}')
+        self.assertEqual(1, mock_request.call_count)
+
+    @patch('urllib3.PoolManager.request')
+    def test_endpoint_pool_latency_only_from_probes(self, mock_request):
+        mock_request.return_value = self.mock_response
+        pool = PicSureClient.EndpointPool(self.test_urls)
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_urls[0], self.test_urls[0], self.test_token,
+                                                          endpoints=pool)
+        test_api_obj.queryResult("some_resource_uuid", "some_query_uuid")
+        self.assertIsNone(pool.endpoints[0].latency)
+        pool.probe(self.test_urls[0])
+        self.assertIsNotNone(pool.endpoints[0].latency)
+
+
+class TestDeadline(unittest.TestCase):
+
+    def setUp(self):
+        self.test_token = "some_security_token"
+        self.test_url_picsure = "http://some.url/PIC-SURE/"
+        self.test_url_psama = "http://some.url/PSAMA/"
+        self.test_uuid = "some_resource_uuid"
+
+        self.mock_response = MagicMock(spec=urllib3.response.HTTPResponse)
+        self.mock_response.status = 200
+        self.mock_response.data = '{"status": "AVAILABLE"}'.encode()
+
+    def test_deadline_caps_timeouts(self):
+        deadline = PicSureClient.Deadline(2)
+        timeout = deadline.timeout(connect=0.5, read=60)
+        self.assertEqual(0.5, timeout.connect_timeout)
+        self.assertTrue(timeout.read_timeout <= 2)
+
+    @patch('urllib3.PoolManager.request')
+    def test_deadline_expired_skips_request(self, mock_request):
+        mock_request.return_value = self.mock_response
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url_picsure, self.test_url_psama, self.test_token)
+        with self.assertRaises(PicSureClient.DeadlineExceeded):
+            test_api_obj.queryResult(self.test_uuid, "some_query_uuid", deadline=PicSureClient.Deadline(0))
+        mock_request.assert_not_called()
+
+    @patch('urllib3.PoolManager.request')
+    def test_deadline_passed_to_request(self, mock_request):
+        mock_request.return_value = self.mock_response
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url_picsure, self.test_url_psama, self.test_token,
+                                                          read_timeout=30)
+        test_api_obj.queryStatus(self.test_uuid, "some_query_uuid", deadline=PicSureClient.Deadline(10))
+        timeout = mock_request.call_args[1]["timeout"]
+        self.assertTrue(timeout.read_timeout <= 10)
+        self.assertFalse(mock_request.call_args[1]["retries"])
+
+    @patch('urllib3.PoolManager.request')
+    def test_read_timeout_is_not_an_invalid_url(self, mock_request):
+        url = self.test_url_picsure + "query/some_query_uuid/result"
+        mock_request.side_effect = urllib3.exceptions.MaxRetryError(
+            None, url, urllib3.exceptions.ReadTimeoutError(None, url, "Read timed out."))
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url_picsure, self.test_url_psama, self.test_token,
+                                                          read_timeout=0.3)
+        assertion = lambda captured: self.assertIn("timed out", captured)
+        with capture_stdout(assertion):
+            self.assertEqual('["ERROR:", "   Timed out"]', test_api_obj.queryResult(self.test_uuid, "some_query_uuid"))
+
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url_picsure, self.test_url_psama, self.test_token,
+                                                          read_timeout=0.3, structured=True)
+        with self.assertRaises(PicSureClient.PicSureHttpError) as context:
+            test_api_obj.queryResult(self.test_uuid, "some_query_uuid")
+        self.assertEqual("Timed out", context.exception.message)
+
+    @patch('time.sleep')
+    @patch('urllib3.PoolManager.request')
+    def test_await_query_polls_until_done(self, mock_request, mock_sleep):
+        pending = MagicMock(spec=urllib3.response.HTTPResponse)
+        pending.status = 200
+        pending.data = '{"status": "RUNNING"}'.encode()
+        mock_request.side_effect = [pending, pending, self.mock_response]
+
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url_picsure, self.test_url_psama, self.test_token)
+        status = test_api_obj.awaitQuery(self.test_uuid, "some_query_uuid", deadline=PicSureClient.Deadline(60))
+        self.assertEqual("AVAILABLE", json.loads(status)["status"])
+        self.assertEqual(3, mock_request.call_count)
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.test_url = "http://some.url/PIC-SURE/"
+        self.test_token = "some_security_token"
+        self.resource_uuids = ["resource-1-uuid", "resource-2-uuid"]
+
+    def fake_request(self, method, url, **kwargs):
+        if url.endswith("info/resources"):
+            return fake_response(json.dumps(self.resource_uuids))
+        elif url.endswith("user/me"):
+            return fake_response(json.dumps({"email": "some@email.edu", "queryTemplate": ""}))
+        return fake_response(json.dumps({"uuid": url.rsplit("/", 1)[-1]}))
+
+    @patch('urllib3.PoolManager.request')
+    def test_prefetch_serves_info_from_memory(self, mock_request):
+        mock_request.side_effect = self.fake_request
+
+        test_conn = PicSureClient.Client.connect(self.test_url, self.test_token, prefetch=True, prefetch_profile=True)
+        self.assertEqual(self.resource_uuids, test_conn.resource_uuids)
+        self.assertEqual({"uuid": "resource-1-uuid"}, json.loads(test_conn.getInfo("resource-1-uuid")))
+        self.assertEqual({"uuid": "resource-2-uuid"}, json.loads(test_conn._api_obj().info("resource-2-uuid")))
+        self.assertEqual("some@email.edu", json.loads(test_conn._api_obj().profile())["email"])
+
+        # one listing, one info per resource and one profile request
+        self.assertEqual(4, mock_request.call_count)
+        test_conn.getInfo("resource-1-uuid")
+        self.assertEqual(4, mock_request.call_count)
+
+    def test_prefetch_does_not_cache_errors(self):
+        cache = PicSureClient.Cache.MetadataCache()
+        self.assertEqual({"error": True}, cache.get(("info", "x"), lambda: {"error": True}))
+        self.assertFalse(("info", "x") in cache)
+
+
+class TestStructuredErrors(unittest.TestCase):
+
+    def setUp(self):
+        self.test_url = "http://some.url/PIC-SURE/"
+        self.test_token = "some_security_token"
+
+        self.mock_response = MagicMock(spec=urllib3.response.HTTPResponse)
+        self.mock_response.status = 200
+        self.mock_response.data = '["SOME-RESOURCE-UUID-HERE"]'.encode()
+
+    @patch('urllib3.PoolManager.request')
+    def test_structured_connect_prints_nothing(self, mock_request):
+        mock_request.return_value = self.mock_response
+        assertion = lambda captured: self.assertEqual("", captured.strip(), "Structured mode should not print")
+        with capture_stdout(assertion):
+            test_conn = PicSureClient.Client.connect(self.test_url, self.test_token, True, structured=True)
+        self.assertEqual(["SOME-RESOURCE-UUID-HERE"], test_conn.resource_uuids)
+
+    @patch('urllib3.PoolManager.request')
+    def test_structured_error_raises_typed_error(self, mock_request):
+        self.mock_response.status = 401
+        self.mock_response.data = 'Unauthorized'.encode()
+        mock_request.return_value = self.mock_response
+
+        with capture_stdout(lambda captured: self.assertEqual("", captured.strip())):
+            with self.assertRaises(PicSureClient.PicSureHttpError) as context:
+                PicSureClient.Client.connect(self.test_url, self.test_token, structured=True)
+        self.assertEqual(401, context.exception.status)
+        self.assertEqual("Token invalid", context.exception.message)
+
+    @patch('urllib3.PoolManager.request')
+    def test_structured_unreachable_raises(self, mock_request):
+        mock_request.side_effect = urllib3.exceptions.NewConnectionError(None, "unreachable")
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url, self.test_url, self.test_token,
+                                                          structured=True)
+        with self.assertRaises(PicSureClient.PicSureHttpError) as context:
+            test_api_obj.queryResult("some_resource_uuid", "some_query_uuid")
+        self.assertIsNone(context.exception.status)
+
+
+class TestFederatedQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.test_token = "some_security_token"
+        self.test_url_picsure = "http://some.url/PIC-SURE/"
+        self.test_url_psama = "http://some.url/PSAMA/"
+        self.resource_uuids = ["resource-1-uuid", "resource-2-uuid", "resource-3-uuid"]
+
+    def fake_request(self, method, url, body=None, **kwargs):
+        resource_uuid = json.loads(body)["resourceUUID"]
+        return fake_response("count for " + resource_uuid, 404 if resource_uuid == "resource-3-uuid" else 200)
+
+    @patch('urllib3.PoolManager.request')
+    def test_federated_query_tags_results(self, mock_request):
+        mock_request.side_effect = self.fake_request
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url_picsure, self.test_url_psama, self.test_token,
+                                                          structured=True)
+        results = {r.resource_uuid: r for r in test_api_obj.federatedQuery(self.resource_uuids, {"query": {}})}
+
+        self.assertEqual(set(self.resource_uuids), set(results.keys()))
+        self.assertEqual("count for resource-1-uuid", results["resource-1-uuid"].result)
+        self.assertIsNone(results["resource-2-uuid"].error)
+        self.assertEqual(404, results["resource-3-uuid"].error.status)
+        self.assertEqual(3, mock_request.call_count)
+
+    @patch('urllib3.PoolManager.request')
+    def test_federated_query_sends_before_iterating(self, mock_request):
+        mock_request.side_effect = self.fake_request
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url_picsure, self.test_url_psama, self.test_token,
+                                                          structured=True)
+        with self.assertRaises(ValueError):
+            test_api_obj.federatedQuery(self.resource_uuids, "not a query")
+
+        results = test_api_obj.federatedQuery(self.resource_uuids, {"query": {}})
+        for i in range(100):
+            if mock_request.call_count == 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(3, mock_request.call_count, "Every query should be sent without iterating the results")
+        self.assertEqual(3, len(list(results)))
+
+    @patch('urllib3.PoolManager.request')
+    def test_federated_query_tags_errors_in_default_mode(self, mock_request):
+        def fake_request(method, url, body=None, **kwargs):
+            resource_uuid = json.loads(body)["resourceUUID"]
+            if resource_uuid == "resource-2-uuid":
+                raise ValueError("unexpected failure")
+            return self.fake_request(method, url, body=body, **kwargs)
+        mock_request.side_effect = fake_request
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url_picsure, self.test_url_psama, self.test_token)
+        with capture_stdout():
+            results = {r.resource_uuid: r for r in test_api_obj.federatedQuery(self.resource_uuids, {"query": {}})}
+
+        self.assertIsNone(results["resource-1-uuid"].error)
+        self.assertIsInstance(results["resource-2-uuid"].error, ValueError)
+        self.assertIsNone(results["resource-3-uuid"].result)
+        self.assertEqual(404, results["resource-3-uuid"].error.status)
+
+
+class TestParsing(unittest.TestCase):
+
+    def setUp(self):
+        rows = [["Patient ID", "\\demographics\\SEX\\", "\\notes\\"]]
+        for i in range(200):
+            rows.append([str(i), "male" if i % 2 else "female", 'line one\nline "two", %d' % i])
+        out = io.StringIO()
+        csv.writer(out).writerows(rows)
+        self.text = out.getvalue()
+        self.rows = rows
+
+    def test_split_rows_respects_quoted_newlines(self):
+        bounds = PicSureClient.Parsing.splitRows(self.text, 7)
+        self.assertTrue(len(bounds) > 1)
+        self.assertEqual(self.text, "".join(self.text[begin:end] for begin, end in bounds))
+        for begin, end in bounds:
+            self.assertEqual(0, self.text.count('"', 0, begin) % 2, "Chunks should only split between rows")
+
+    def test_parse_csv_in_process_pool(self):
+        columns = PicSureClient.parseCsv(self.text, processes=3, min_chunk_size=100)
+        self.assertEqual(self.rows[0], list(columns.keys()))
+        sex = columns["\\demographics\\SEX\\"]
+        self.assertTrue(len(sex.parts) > 1, "Large results should be parsed in several chunks")
+        self.assertEqual([row[1] for row in self.rows[1:]], list(sex))
+        self.assertEqual(self.rows[-1][2], columns["\\notes\\"][-1])
+        self.assertEqual(self.rows[101][0], columns["Patient ID"][100])
+
+    @patch('PicSureClient.Parsing.ProcessPoolExecutor')
+    def test_parse_csv_single_process_stays_in_process(self, mock_executor):
+        columns = PicSureClient.parseCsv(self.text, processes=1, min_chunk_size=100)
+        mock_executor.assert_not_called()
+        self.assertEqual(1, len(columns["Patient ID"].parts))
+        self.assertEqual([row[0] for row in self.rows[1:]], list(columns["Patient ID"]))
+
+    def test_parse_csv_skips_blank_lines(self):
+        columns = PicSureClient.parseCsv("a,b\n1,2\n\n3,4\n")
+        self.assertEqual(["1", "3"], list(columns["a"]))
+        self.assertEqual(["2", "4"], list(columns["b"]))
+
+
+class TestResultStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "result.psr")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_result_store_round_trip(self):
+        text = 'Patient ID,\\demographics\\SEX\\,\\demographics\\AGE\\\n1,male,42\n2,female,\n3,"fe,male",7.5\n'
+        PicSureClient.saveResult(self.path, PicSureClient.parseCsv(text))
+
+        with PicSureClient.openResult(self.path) as stored:
+            self.assertEqual(3, stored.rows)
+            self.assertEqual(["Patient ID", "\\demographics\\SEX\\", "\\demographics\\AGE\\"], stored.keys())
+            self.assertEqual([1.0, 2.0, 3.0], list(stored["Patient ID"]))
+            age = stored["\\demographics\\AGE\\"]
+            self.assertEqual(42.0, age[0])
+            self.assertTrue(math.isnan(age[1]))
+            sex = stored["\\demographics\\SEX\\"]
+            self.assertEqual(["male", "female", "fe,male"], list(sex))
+            self.assertEqual("fe,male", sex[-1])
+            self.assertEqual([0, 1, 2], list(sex.codes))
+
+    def test_result_store_keeps_inexact_numbers_as_text(self):
+        columns = {"zip": ["02115", "10001"], "label": ["nan", "1"], "id": ["12345678901234567890", "1"],
+                   "exp": ["1e5", "2"], "count": ["3", "-4.25"]}
+        PicSureClient.saveResult(self.path, columns)
+        with PicSureClient.openResult(self.path) as stored:
+            self.assertEqual(["02115", "10001"], list(stored["zip"]))
+            self.assertEqual(["nan", "1"], list(stored["label"]))
+            self.assertEqual(["12345678901234567890", "1"], list(stored["id"]))
+            self.assertEqual(["1e5", "2"], list(stored["exp"]))
+            self.assertEqual([3.0, -4.25], list(stored["count"]))
+
+    def test_result_store_close_with_slices_held(self):
+        PicSureClient.saveResult(self.path, {"age": ["1", "2", "3"], "sex": ["male", "female", "male"]})
+        with PicSureClient.openResult(self.path) as stored:
+            ages = stored["age"][0:2]
+            codes = stored["sex"].codes[1:]
+        self.assertEqual([1.0, 2.0], list(ages))
+        self.assertEqual([1, 0], list(codes))
+
+    def test_result_store_rejects_other_files(self):
+        with open(self.path, 'wb') as f:
+            f.write(b"not a result file at all")
+        with self.assertRaises(ValueError):
+            PicSureClient.openResult(self.path)
+
+
+class TestSessionSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.test_url = "http://some.url/PIC-SURE/"
+        self.test_urls = ["http://region-a.url/PIC-SURE/", "http://region-b.url/PIC-SURE/"]
+        self.test_psama = "http://auth.url/psama/"
+        self.test_token = "some_security_token"
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "session.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def fake_request(self, method, url, **kwargs):
+        if url.endswith("info/resources"):
+            return fake_response(json.dumps({"resource-1-uuid": "hpds"}))
+        elif url.endswith("user/me"):
+            return fake_response(json.dumps({"email": "some@email.edu", "queryTemplate": "{}"}))
+        return fake_response(json.dumps({"uuid": url.rsplit("/", 1)[-1]}))
+
+    @patch('urllib3.PoolManager.request')
+    def test_session_restore_makes_no_requests(self, mock_request):
+        mock_request.side_effect = self.fake_request
+        test_conn = PicSureClient.Client.connect(self.test_url, self.test_token, structured=True, prefetch=True)
+        test_conn.getInfo("resource-1-uuid")
+        test_conn.saveSession(self.path)
+
+        with open(self.path) as f:
+            self.assertNotIn(self.test_token, f.read(), "The token should not be saved unless asked for")
+
+        mock_request.reset_mock()
+        restored = PicSureClient.Client.restore(self.path, token=self.test_token, structured=True)
+        self.assertEqual(["resource-1-uuid"], restored.resource_uuids)
+        self.assertEqual({"uuid": "resource-1-uuid"}, json.loads(restored.getInfo("resource-1-uuid")))
+        self.assertEqual("{}", json.loads(restored._api_obj().profile())["queryTemplate"])
+        mock_request.assert_not_called()
+
+    @patch('urllib3.PoolManager.request')
+    def test_session_restore_needs_token(self, mock_request):
+        mock_request.side_effect = self.fake_request
+        PicSureClient.Client.connect(self.test_url, self.test_token, structured=True).saveSession(self.path)
+        with self.assertRaises(PicSureClient.PicSureClientException):
+            PicSureClient.Client.restore(self.path)
+
+        PicSureClient.Client.connect(self.test_url, self.test_token, structured=True).saveSession(
+            self.path, include_token=True)
+        self.assertEqual(self.test_token, PicSureClient.Client.restore(self.path, structured=True)._token)
+
+    @patch('urllib3.PoolManager.request')
+    def test_session_restore_refreshes_stale_entries(self, mock_request):
+        mock_request.side_effect = self.fake_request
+        PicSureClient.Client.connect(self.test_url, self.test_token, structured=True).saveSession(self.path)
+        mock_request.reset_mock()
+
+        with patch('time.time', return_value=time.time() + 120):
+            PicSureClient.Client.restore(self.path, token=self.test_token, max_age=60, structured=True)
+        mock_request.assert_called_once()
+
+    @patch('urllib3.PoolManager.request')
+    def test_session_restore_multi_endpoint_makes_no_requests(self, mock_request):
+        mock_request.side_effect = self.fake_request
+        test_conn = PicSureClient.Client.connect(self.test_urls, self.test_token, structured=True,
+                                                 psama_override=self.test_psama, health_check_interval=3600)
+        test_conn.close()
+        test_conn.endpoints.recordSuccess(self.test_urls[1], 0.01)
+        test_conn.endpoints.recordSuccess(self.test_urls[0], 0.5)
+        test_conn.saveSession(self.path)
+
+        mock_request.reset_mock()
+        restored = PicSureClient.Client.restore(self.path, token=self.test_token, structured=True)
+        try:
+            self.assertEqual(self.test_psama, restored.psama_url)
+            self.assertIsNone(restored.psama_endpoints)
+            self.assertEqual(self.test_urls[1], restored.endpoints.best())
+            self.assertEqual("{}", json.loads(restored._api_obj().profile())["queryTemplate"])
+            mock_request.assert_not_called()
+        finally:
+            restored.close()
+
+    @unittest.skipUnless(hasattr(os, 'fchmod'), "file modes are POSIX only")
+    @patch('urllib3.PoolManager.request')
+    def test_session_with_token_is_private(self, mock_request):
+        mock_request.side_effect = self.fake_request
+        with open(self.path, 'w') as f:
+            f.write("{}")
+        os.chmod(self.path, 0o644)
+        PicSureClient.Client.connect(self.test_url, self.test_token, structured=True).saveSession(
+            self.path, include_token=True)
+        self.assertEqual(0o600, os.stat(self.path).st_mode & 0o777)
+
+    @patch('urllib3.PoolManager.request')
+    def test_session_not_saved_without_listing(self, mock_request):
+        mock_request.side_effect = lambda method, url, **kwargs: fake_response("Unauthorized", 401)
+        with capture_stdout():
+            test_conn = PicSureClient.Client.connect(self.test_url, self.test_token)
+        with self.assertRaises(PicSureClient.PicSureClientException):
+            test_conn.saveSession(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.test_token = "some_security_token"
+        self.test_url_picsure = "http://some.url/PIC-SURE/"
+        self.test_url_psama = "http://some.url/PSAMA/"
+
+        self.mock_response = MagicMock(spec=urllib3.response.HTTPResponse)
+        self.mock_response.status = 200
+        self.mock_response.data = ("Patient ID,\\demographics\\SEX\\\n" + "1,male\n" * 1000).encode()
+
+    @patch('urllib3.PoolManager.request')
+    def test_profiling_records_request_phases(self, mock_request):
+        mock_request.return_value = self.mock_response
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url_picsure, self.test_url_psama, self.test_token)
+
+        with test_api_obj.picsureHttpConnect.profiling() as profiler:
+            columns = test_api_obj.queryResultColumns("some_resource_uuid", "some_query_uuid")
+        self.assertEqual(1000, len(columns["Patient ID"]))
+        self.assertIsNone(test_api_obj.picsureHttpConnect.profiler, "Profiling should stop after the with block")
+
+        summary = profiler.summary()
+        self.assertEqual(["receive", "decode", "parse"], list(summary.keys()))
+        self.assertTrue(summary["decode"]["max_net_bytes"] >= len(self.mock_response.data))
+        self.assertTrue(profiler.peak_bytes >= summary["decode"]["max_net_bytes"])
+        self.assertTrue(profiler.report().index("Process peak") > 0)
+
+    def test_profiling_does_not_serialize_phases(self):
+        both_receiving = threading.Barrier(2, timeout=5)
+        failures = []
+
+        with PicSureClient.RequestProfiler() as profiler:
+            def receive():
+                with profiler.phase("receive"):
+                    try:
+                        both_receiving.wait()
+                    except threading.BrokenBarrierError as e:
+                        failures.append(e)
+
+            threads = [threading.Thread(target=receive) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([], failures, "Concurrent requests should stay concurrent while profiling")
+        self.assertEqual(2, profiler.summary()["receive"]["count"])
+
+    @patch('urllib3.PoolManager.request')
+    def test_query_result_columns_raises_on_error(self, mock_request):
+        self.mock_response.status = 500
+        self.mock_response.headers = {}
+        mock_request.return_value = self.mock_response
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url_picsure, self.test_url_psama, self.test_token)
+        with capture_stdout():
+            with self.assertRaises(PicSureClient.PicSureHttpError) as context:
+                test_api_obj.queryResultColumns("some_resource_uuid", "some_query_uuid")
+        self.assertEqual(500, context.exception.status)
+
+
+class TestConcurrencyLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.test_token = "some_security_token"
+        self.test_url_picsure = "http://some.url/PIC-SURE/"
+        self.test_url_psama = "http://some.url/PSAMA/"
+
+        self.mock_response = MagicMock(spec=urllib3.response.HTTPResponse)
+        self.mock_response.status = 200
+        self.mock_response.data = '{"results": {}}'.encode()
+
+    def test_limiter_additive_increase(self):
+        limiter = PicSureClient.ConcurrencyLimiter(initial=2, maximum=4)
+        for i in range(20):
+            self.assertTrue(limiter.acquire(0))
+            limiter.release(0.1, 200)
+        self.assertEqual(4, limiter.limit)
+
+    def test_limiter_multiplicative_decrease(self):
+        limiter = PicSureClient.ConcurrencyLimiter(initial=8)
+        limiter.acquire(0)
+        limiter.release(0.1, 429)
+        self.assertEqual(4, limiter.limit)
+        self.assertEqual(1, limiter.metrics()["decreases"])
+
+    def test_limiter_steady_latency_does_not_shrink(self):
+        limiter = PicSureClient.ConcurrencyLimiter(initial=4)
+        for i in range(200):
+            limiter.acquire(0)
+            limiter.release(1.5, 200)
+        self.assertTrue(limiter.limit > 4)
+        self.assertEqual(0, limiter.metrics()["decreases"])
+
+    def test_limiter_recovers_after_one_fast_call(self):
+        clock = [0.0]
+        limiter = PicSureClient.ConcurrencyLimiter(initial=4)
+        with patch('time.monotonic', side_effect=lambda: clock[0]):
+            limiter.acquire(0)
+            limiter.release(0.02, 200)
+            for i in range(200):
+                clock[0] += 1.5
+                limiter.acquire(0)
+                limiter.release(1.5, 200)
+        self.assertTrue(limiter.limit > 4, limiter.metrics())
+
+    def test_limiter_backs_off_as_latency_rises_under_load(self):
+        clock = [0.0]
+        limiter = PicSureClient.ConcurrencyLimiter(initial=4, maximum=64)
+        with patch('time.monotonic', side_effect=lambda: clock[0]):
+            for i in range(500):
+                inflight = limiter.limit
+                # a server with room for 8 requests, beyond that latency grows with the queue
+                latency = 0.02 * max(1.0, inflight / 8.0)
+                for j in range(inflight):
+                    limiter.acquire(0)
+                clock[0] += latency
+                for j in range(inflight):
+                    limiter.release(latency, 200)
+        self.assertTrue(limiter.metrics()["decreases"] > 0)
+        self.assertTrue(limiter.limit < 32, limiter.metrics())
+
+    def test_limiter_blocks_at_limit(self):
+        limiter = PicSureClient.ConcurrencyLimiter(initial=1)
+        self.assertTrue(limiter.acquire(0))
+        self.assertFalse(limiter.acquire(0.01))
+
+    @patch('urllib3.PoolManager.request')
+    def test_limiter_observes_requests(self, mock_request):
+        self.mock_response.status = 503
+        mock_request.return_value = self.mock_response
+        limiter = PicSureClient.ConcurrencyLimiter(initial=8)
+        test_api_obj = PicSureClient.PicSureConnectionAPI(self.test_url_picsure, self.test_url_psama, self.test_token,
+                                                          structured=True, concurrency=limiter)
+        with self.assertRaises(PicSureClient.PicSureHttpError):
+            test_api_obj.queryResult("some_resource_uuid", "some_query_uuid")
+        self.assertEqual({"limit": 4, "inflight": 0, "latency": None, "baseline": None, "decreases": 1},
+                         limiter.metrics())